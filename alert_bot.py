@@ -1,15 +1,35 @@
 import os
+import re
+import sys
+import hashlib
+import secrets
 import json
+import time
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
+import numpy as np
 import yfinance as yf
 
+try:
+    import uvloop
+except ImportError:  # Windows / local runs without it
+    uvloop = None
+
 from telegram import Update
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     ContextTypes,
@@ -20,15 +40,202 @@ from telegram.ext import (
 # =========================
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Public base URL (Render web services set RENDER_EXTERNAL_URL). When present
+# Telegram pushes updates to us; without it the bot falls back to polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token and PTB rejects
+# requests without it. If unset, a fresh one is registered on every start.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+PORT = int(os.getenv("PORT", "10000"))
 
 # =========================
 # DB HELPERS
 # =========================
+DB_POOL_MAX = 10
+# psycopg2's pool closes any connection returned beyond minconn, so keep
+# all of them: concurrent handlers reuse their TLS session and PREPAREs
+DB_POOL_MIN = DB_POOL_MAX
+# for every connection, pooled or LISTEN. sslmode=require funciona bien en
+# Render Postgres; keepalives let the kernel notice connections Render
+# dropped while idle
+DB_CONNECT_KWARGS = {
+    "sslmode": "require",
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
+
+_DB_POOL = None
+
+
+class PreparedConnection(PgConnection):
+    """
+    Pooled connection that remembers which PREPARED_SQL names it already
+    sent to the server (prepared statements live as long as the session).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Every handler registers its user in the same round-trip as its real work:
+# $1 = telegram_id, $2 = username. Data-modifying CTEs always run to completion.
+USER_CTE = """
+    WITH u AS (
+        INSERT INTO users (telegram_id, username)
+        VALUES ($1, $2)
+        ON CONFLICT (telegram_id)
+        DO UPDATE SET username = EXCLUDED.username
+        -- read-only commands should not rewrite an unchanged row
+        WHERE users.username IS DISTINCT FROM EXCLUDED.username
+    )
+"""
+
+# name -> (parameter types, statement). Hot per-command statements only.
+PREPARED_SQL = {
+    "start_tickers": ("BIGINT, TEXT", USER_CTE + """
+        SELECT ticker FROM alerts WHERE telegram_id=$1 ORDER BY ticker
+    """),
+    "list_alerts": ("BIGINT, TEXT", USER_CTE + """
+        SELECT ticker, drop_pct
+        FROM alerts
+        WHERE telegram_id=$1
+        ORDER BY ticker
+    """),
+    "show_alert": ("BIGINT, TEXT, TEXT", USER_CTE + """
+        SELECT ticker, drop_pct, entry_price, tp_pct, sl_pct, dca_rules
+        FROM alerts
+        WHERE telegram_id=$1 AND ticker=$3
+    """),
+    "remove_alert": ("BIGINT, TEXT, TEXT", USER_CTE + """
+        DELETE FROM alerts WHERE telegram_id=$1 AND ticker=$3
+    """),
+    "set_drop": ("BIGINT, TEXT, TEXT, NUMERIC", USER_CTE + """
+        INSERT INTO alerts (telegram_id, ticker, drop_pct)
+        VALUES ($1, $3, $4)
+        ON CONFLICT (telegram_id, ticker)
+        DO UPDATE SET drop_pct = EXCLUDED.drop_pct
+    """),
+    "set_entry": ("BIGINT, TEXT, TEXT, NUMERIC", USER_CTE + """
+        INSERT INTO alerts (telegram_id, ticker, entry_price)
+        VALUES ($1, $3, $4)
+        ON CONFLICT (telegram_id, ticker)
+        DO UPDATE SET entry_price = EXCLUDED.entry_price
+    """),
+    "set_sell": ("BIGINT, TEXT, TEXT, NUMERIC, NUMERIC", USER_CTE + """
+        INSERT INTO alerts (telegram_id, ticker, tp_pct, sl_pct)
+        VALUES ($1, $3, $4, $5)
+        ON CONFLICT (telegram_id, ticker)
+        DO UPDATE SET tp_pct = EXCLUDED.tp_pct, sl_pct = EXCLUDED.sl_pct
+    """),
+    "set_dca": ("BIGINT, TEXT, TEXT, JSONB", USER_CTE + """
+        INSERT INTO alerts (telegram_id, ticker, dca_rules)
+        VALUES ($1, $3, $4)
+        ON CONFLICT (telegram_id, ticker)
+        DO UPDATE SET dca_rules = EXCLUDED.dca_rules
+    """),
+    "set_budget": ("BIGINT, TEXT, NUMERIC, NUMERIC", USER_CTE + """
+        INSERT INTO budgets (telegram_id, weekly_budget, dips_budget, updated_at)
+        VALUES ($1, $3, $4, NOW())
+        ON CONFLICT (telegram_id)
+        DO UPDATE SET weekly_budget=EXCLUDED.weekly_budget, dips_budget=EXCLUDED.dips_budget, updated_at=NOW()
+    """),
+    # the DELETE sees the pre-statement snapshot, so it never removes the new rows
+    "set_plan": ("BIGINT, TEXT, TEXT[], NUMERIC[]", USER_CTE + """
+        , d AS (DELETE FROM plans WHERE telegram_id=$1)
+        INSERT INTO plans (telegram_id, ticker, amount)
+        SELECT $1, t.ticker, t.amount FROM unnest($3, $4) AS t(ticker, amount)
+    """),
+    "monday_budget": ("BIGINT, TEXT", USER_CTE + """
+        SELECT weekly_budget, dips_budget FROM budgets WHERE telegram_id=$1
+    """),
+}
+
+
+def execute_prepared(cur, name: str, params):
+    """
+    EXECUTE a PREPARED_SQL statement, preparing it on first use per connection
+    so Postgres skips parse/plan on every later call.
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        types, sql = PREPARED_SQL[name]
+        cur.execute(f"PREPARE {name} ({types}) AS {sql}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+# Dedicated autocommit connection LISTENing on SNAPSHOT_CHANNEL (not pooled:
+# a LISTEN only hears notifications on the session that issued it)
+SNAPSHOT_CHANNEL = "alerts_changed"
+_LISTEN_CONN = None
+
+
+def db_pool():
+    """
+    Lazily builds the process-wide connection pool.
+    One TLS handshake per pooled connection instead of one per query.
+    """
+    global _DB_POOL
+    if _DB_POOL is None:
+        if not DATABASE_URL:
+            raise RuntimeError("Falta DATABASE_URL en Render (Environment Variables).")
+        _DB_POOL = ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            DATABASE_URL,
+            connection_factory=PreparedConnection,
+            cursor_factory=RealDictCursor,
+            **DB_CONNECT_KWARGS,
+        )
+    return _DB_POOL
+
+
+@contextmanager
 def db_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("Falta DATABASE_URL en Render (Environment Variables).")
-    # sslmode=require funciona bien en Render Postgres
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor, sslmode="require")
+    pool = db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # connections dropped by the server are discarded instead of reused
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def db_close():
+    global _DB_POOL, _LISTEN_CONN
+    if _DB_POOL is not None:
+        _DB_POOL.closeall()
+        _DB_POOL = None
+    if _LISTEN_CONN is not None:
+        _LISTEN_CONN.close()
+        _LISTEN_CONN = None
+
+
+async def db_run(fn, *args):
+    """
+    Runs a blocking DB helper on the default executor so the event loop
+    keeps serving other chats while psycopg2 waits on the network.
+    A connection that went stale in the pool (e.g. after a Postgres restart)
+    fails once, gets discarded by db_conn, and the call is retried on a
+    fresh one.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, fn, *args)
+    except psycopg2.OperationalError:
+        return await loop.run_in_executor(None, fn, *args)
 
 
 def db_init():
@@ -82,25 +289,52 @@ def db_init():
             );
             """)
 
-            conn.commit()
+            # 60d high per ticker, refreshed once per UTC day (survives restarts)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS price_highs (
+                ticker TEXT PRIMARY KEY,
+                high_60d NUMERIC NOT NULL,
+                asof DATE NOT NULL
+            );
+            """)
 
+            # alerts(telegram_id, ticker) is already covered by its UNIQUE index
+            cur.execute("CREATE INDEX IF NOT EXISTS plans_tg_idx ON plans(telegram_id);")
+            # the snapshot reads every active row, so an index there only slowed writes
+            cur.execute("DROP INDEX IF EXISTS alerts_active_idx;")
 
-def upsert_user(update: Update):
-    tg_id = update.effective_user.id
-    username = update.effective_user.username
-    with db_conn() as conn:
-        with conn.cursor() as cur:
+            # Tell every bot process when the checker snapshot goes stale.
+            # The checker's own last_* stamps are not in the column list.
             cur.execute("""
-            INSERT INTO users (telegram_id, username)
-            VALUES (%s, %s)
-            ON CONFLICT (telegram_id)
-            DO UPDATE SET username = EXCLUDED.username;
-            """, (tg_id, username))
+            CREATE OR REPLACE FUNCTION notify_snapshot_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('""" + SNAPSHOT_CHANNEL + """', TG_TABLE_NAME);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS alerts_snapshot_notify ON alerts;")
+            cur.execute("""
+            CREATE TRIGGER alerts_snapshot_notify
+            AFTER INSERT OR DELETE OR UPDATE OF drop_pct, entry_price, tp_pct, sl_pct, dca_rules ON alerts
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_snapshot_changed();
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS budgets_snapshot_notify ON budgets;")
+            cur.execute("""
+            CREATE TRIGGER budgets_snapshot_notify
+            AFTER INSERT OR DELETE OR UPDATE ON budgets
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_snapshot_changed();
+            """)
+
             conn.commit()
 
 
 def normalize_ticker(t: str) -> str:
-    return (t or "").strip().upper()
+    """
+    The one place a ticker is normalized: stored keys are already upper-case,
+    so nothing downstream re-normalizes them.
+    """
+    return sys.intern((t or "").strip().upper())
 
 
 def now_utc():
@@ -110,28 +344,295 @@ def now_utc():
 # =========================
 # PRICE HELPERS (yfinance)
 # =========================
-def fetch_price_and_60d_high(ticker: str):
+# below the 300s checker interval: each run sees a fresh price, the cache
+# only saves refetches within one run
+PRICE_CACHE_TTL = 240  # seconds
+# concurrent Yahoo requests, both yf.download's threads and the per-ticker
+# fallback; lower it if Yahoo starts answering 429
+PRICE_FETCH_WORKERS_DEFAULT = 8
+
+
+def _env_workers(name: str, default: int) -> int:
     """
-    Returns: (current_price, high_60d)
-    Uses yfinance history. (Simple + reliable)
+    Positive int from the environment; junk falls back to the default and
+    anything below 1 becomes 1 (ThreadPoolExecutor rejects 0 workers).
     """
-    tk = yf.Ticker(ticker)
+    try:
+        return max(1, int(os.getenv(name, default)))
+    except ValueError:
+        return default
 
-    # last ~3 months is enough to compute 60 trading days
-    hist = tk.history(period="3mo", interval="1d")
+
+PRICE_FETCH_WORKERS = _env_workers("PRICE_FETCH_WORKERS", PRICE_FETCH_WORKERS_DEFAULT)
+
+# Full window once per day, then only the last few bars
+FULL_HISTORY_PERIOD = "3mo"
+RECENT_HISTORY_PERIOD = "5d"
+
+# ticker -> (current_price, high_60d, fetched_at monotonic)
+_PRICE_CACHE = {}
+# ticker -> (high_60d, utc date it was computed from the full window)
+_HIGH_CACHE = {}
+# full-window highs computed since the last write to price_highs
+_HIGH_PENDING = {}
+_HIGH_CACHE_WARM = False
+_PRICE_CACHE_LOCK = threading.Lock()
+
+
+def _us_market_open(ts: float) -> bool:
+    """
+    Rough US cash session in UTC, wide enough for both EST and EDT.
+    Holidays count as open; that only costs a run with nothing to report.
+    Integer math on epoch seconds.
+    """
+    day, secs = divmod(int(ts), 86400)
+    # epoch day 0 was a Thursday; Monday = 0
+    if (day + 3) % 7 >= 5:
+        return False
+    return (13 * 60 + 30) * 60 <= secs < (21 * 60 + 15) * 60
+
+
+# Plain US listing: QQQ, AAPL, BRK-B. Anything else (7203.T, SAP.DE,
+# EURUSD=X, ES=F, ^N225, BTC-EUR, ETH-USD) trades on its own clock.
+_US_SESSION_TICKER_RE = re.compile(r"[A-Z]{1,5}(?:-[A-Z]{1,2})?")
+
+
+def _follows_us_session(ticker: str) -> bool:
+    """
+    True only for symbols whose daily bar is frozen outside the US cash
+    session; unknown shapes are treated as always trading.
+    """
+    return _US_SESSION_TICKER_RE.fullmatch(ticker) is not None
+
+
+def _cache_get(ticker: str, need_high: bool = True):
+    with _PRICE_CACHE_LOCK:
+        hit = _PRICE_CACHE.get(ticker)
+    if hit and (time.monotonic() - hit[2]) < PRICE_CACHE_TTL:
+        if hit[1] is not None or not need_high:
+            return hit[0], hit[1]
+    return None
+
+
+def _cache_put(ticker: str, current, high_60d):
+    if current is None:
+        return
+    with _PRICE_CACHE_LOCK:
+        _PRICE_CACHE[ticker] = (current, high_60d, time.monotonic())
+
+
+def _known_high(ticker: str):
+    """
+    60d high computed earlier today, or None if a full refresh is due.
+    """
+    with _PRICE_CACHE_LOCK:
+        hit = _HIGH_CACHE.get(ticker)
+    if hit and hit[1] == now_utc().date():
+        return hit[0]
+    return None
+
+
+def _history_period(ticker: str, need_high: bool = True):
+    if not need_high or _known_high(ticker) is not None:
+        return RECENT_HISTORY_PERIOD
+    return FULL_HISTORY_PERIOD
+
+
+def _price_from_hist(ticker: str, hist, period: str):
+    """
+    hist: daily OHLC DataFrame -> (current_price, high_60d)
+    """
     if hist is None or hist.empty:
         return None, None
+    # float64 column views, no intermediate DataFrame
+    close = hist["Close"].to_numpy(dtype=np.float64, copy=False)
+    high = hist["High"].to_numpy(dtype=np.float64, copy=False)
+    return _price_from_arr(ticker, close, high, period)
+
+
+def _price_from_arr(ticker: str, close, high, period: str):
+    """
+    close, high: float64 daily arrays, oldest first -> (current_price, high_60d)
+    A short `period` is merged with the high remembered from today's full fetch;
+    without one, high_60d is None (a few bars say nothing about 60 days).
+    """
+    # rows without a close (e.g. a ticker with a shorter history in a batch);
+    # usually there are none and the arrays stay views
+    ok = ~np.isnan(close)
+    if not ok.all():
+        close, high = close[ok], high[ok]
+    if not len(close):
+        return None, None
 
     # current price: last Close
-    current = float(hist["Close"].iloc[-1])
+    current = float(close[-1])
 
     # 60-day high: max of last ~60 rows (if fewer, use all)
-    tail = hist.tail(60)
-    high_60d = float(tail["High"].max())
+    high_60d = float(np.nanmax(high[-60:]))
 
+    if period == FULL_HISTORY_PERIOD:
+        with _PRICE_CACHE_LOCK:
+            _HIGH_CACHE[ticker] = (high_60d, now_utc().date())
+            _HIGH_PENDING[ticker] = (high_60d, now_utc().date())
+    else:
+        known = _known_high(ticker)
+        high_60d = max(high_60d, known) if known is not None else None
+
+    return current, high_60d
+
+
+@lru_cache(maxsize=256)
+def _yf_ticker(ticker: str):
+    # reused across runs so yfinance keeps its per-symbol state (timezone, metadata)
+    return yf.Ticker(ticker)
+
+
+def fetch_price_and_60d_high(ticker: str, need_high: bool = True):
+    """
+    Returns: (current_price, high_60d)
+    Cached per ticker for PRICE_CACHE_TTL seconds, shorter than the checker
+    interval so alerts never run on the previous run's price.
+    need_high=False (TP/SL only) settles for recent bars; high_60d may be None.
+    """
+    hit = _cache_get(ticker, need_high)
+    if hit:
+        return hit
+
+    tk = _yf_ticker(ticker)
+
+    # last ~3 months is enough to compute 60 trading days
+    period = _history_period(ticker, need_high)
+    hist = tk.history(period=period, interval="1d", actions=False)
+    current, high_60d = _price_from_hist(ticker, hist, period)
+    _cache_put(ticker, current, high_60d)
     return current, high_60d
 
 
+def _download_batch(tickers, period: str):
+    """
+    One yf.download request for many tickers -> {ticker: (current, high_60d)}
+    Tickers Yahoo returns nothing for are left out.
+    """
+    df = yf.download(
+        tickers,
+        period=period,
+        interval="1d",
+        actions=False,
+        group_by="ticker",
+        # otherwise yfinance starts up to 2 * cpu_count threads of its own
+        threads=PRICE_FETCH_WORKERS,
+        progress=False,
+    )
+    out = {}
+    if df is None or df.empty:
+        return out
+
+    # one float64 matrix for the whole batch; per ticker, only pick its
+    # Close/High column positions instead of slicing a DataFrame
+    arr = df.to_numpy(dtype=np.float64)
+    for t in tickers:
+        try:
+            ci, hi = df.columns.get_loc((t, "Close")), df.columns.get_loc((t, "High"))
+        except KeyError:
+            continue
+        current, high_60d = _price_from_arr(t, arr[:, ci], arr[:, hi], period)
+        if current is not None:
+            out[t] = (current, high_60d)
+    return out
+
+
+def _warm_high_cache():
+    """
+    Loads today's persisted 60d highs once per process, so a restart or
+    redeploy does not re-download the full window for every ticker.
+    Best effort: on a DB error the full windows are downloaded instead and
+    the next fetch tries again.
+    """
+    global _HIGH_CACHE_WARM
+    if _HIGH_CACHE_WARM:
+        return
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT ticker, high_60d, asof FROM price_highs WHERE asof = %s;", (now_utc().date(),))
+                rows = cur.fetchall() or []
+    except psycopg2.Error:
+        return
+    with _PRICE_CACHE_LOCK:
+        for r in rows:
+            _HIGH_CACHE.setdefault(r["ticker"], (float(r["high_60d"]), r["asof"]))
+    _HIGH_CACHE_WARM = True
+
+
+def _persist_highs():
+    """
+    Best effort: a failed write must not cost the run its alerts, so the
+    rows go back to _HIGH_PENDING for the next run.
+    """
+    with _PRICE_CACHE_LOCK:
+        rows = [(t, high, asof) for t, (high, asof) in _HIGH_PENDING.items()]
+        _HIGH_PENDING.clear()
+    if not rows:
+        return
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                INSERT INTO price_highs (ticker, high_60d, asof)
+                VALUES %s
+                ON CONFLICT (ticker)
+                DO UPDATE SET high_60d = EXCLUDED.high_60d, asof = EXCLUDED.asof;
+                """, rows)
+                conn.commit()
+    except psycopg2.Error:
+        with _PRICE_CACHE_LOCK:
+            # anything computed meanwhile is newer; keep it
+            for t, high, asof in rows:
+                _HIGH_PENDING.setdefault(t, (high, asof))
+
+
+def fetch_prices(tickers, need_high=None):
+    """
+    Returns: {ticker: (current_price, high_60d)}
+    need_high: tickers whose 60d high matters (BUY alerts); default all.
+    Fresh cache entries are reused, the rest come from batched downloads
+    (one per history period); anything a batch misses falls back to
+    per-ticker fetches.
+    """
+    _warm_high_cache()
+    if need_high is None:
+        need_high = set(tickers)
+
+    out = {}
+    by_period = {}
+    for t in tickers:
+        hit = _cache_get(t, t in need_high)
+        if hit:
+            out[t] = hit
+        else:
+            by_period.setdefault(_history_period(t, t in need_high), []).append(t)
+
+    missing = []
+    for period, group in by_period.items():
+        if len(group) > 1:
+            try:
+                batch = _download_batch(group, period)
+            except Exception:
+                batch = {}
+            for t, (current, high_60d) in batch.items():
+                _cache_put(t, current, high_60d)
+                out[t] = (current, high_60d)
+        missing.extend(t for t in group if t not in out)
+
+    if missing:
+        workers = min(PRICE_FETCH_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            out.update(zip(missing, ex.map(fetch_price_and_60d_high, missing, [t in need_high for t in missing])))
+
+    _persist_highs()
+    return out
+
+
 # =========================
 # FORMATTERS
 # =========================
@@ -153,37 +654,43 @@ def fmt_pct(x):
         return str(x)
 
 
+# one whole DROP:AMOUNT token, e.g. 10:15 or 12.5:40
+_DCA_RULE_RE = re.compile(r"(?<!\S)(\d+(?:\.\d+)?):(\d+(?:\.\d+)?)(?!\S)")
+
+
 def parse_dca_rules(parts):
     """
     Input: ["10:15","15:25","20:40"] -> list of dicts sorted by drop asc
     Each is {"drop":10.0, "amount":15.0}
+    Tokens that are not DROP:AMOUNT are skipped; callers compare lengths.
     """
-    rules = []
-    for p in parts:
-        p = p.strip()
-        if not p or ":" not in p:
-            continue
-        a, b = p.split(":", 1)
-        drop = float(a)
-        amt = float(b)
-        rules.append({"drop": drop, "amount": amt})
-    rules.sort(key=lambda r: r["drop"])
-    return rules
+    pairs = sorted((float(a), float(b)) for a, b in _DCA_RULE_RE.findall(" ".join(parts)))
+    return [{"drop": drop, "amount": amt} for drop, amt in pairs]
+
+
+def dca_rules_array(dca_rules):
+    """
+    Stored rules (list of dicts) -> float array of shape (N, 2): drop, amount
+    Sorted by drop asc, ready for dca_suggest_amount.
+    """
+    arr = np.array([(float(r["drop"]), float(r["amount"])) for r in dca_rules or []], dtype=np.float64)
+    if not len(arr):
+        return arr.reshape(0, 2)
+    return arr[np.argsort(arr[:, 0], kind="stable")]
 
 
 def dca_suggest_amount(dca_rules, drop_pct, dips_budget):
     """
     If drop >= rule.drop => candidate amount
     Return the highest matched rule amount, capped by dips_budget (if dips_budget>0)
+    dca_rules: array from dca_rules_array; the last rule with drop <= drop_pct wins.
     """
-    if not dca_rules or drop_pct is None:
+    if drop_pct is None or not len(dca_rules):
         return None
-    best = None
-    for r in dca_rules:
-        if drop_pct >= float(r["drop"]):
-            best = float(r["amount"])
-    if best is None:
+    idx = int(np.searchsorted(dca_rules[:, 0], drop_pct, side="right")) - 1
+    if idx < 0:
         return None
+    best = float(dca_rules[idx, 1])
     if dips_budget is not None and float(dips_budget) > 0:
         return float(min(best, float(dips_budget)))
     return best
@@ -193,13 +700,18 @@ def dca_suggest_amount(dca_rules, drop_pct, dips_budget):
 # COMMANDS
 # =========================
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT ticker FROM alerts WHERE telegram_id=%s ORDER BY ticker;", (tg_id,))
-            tickers = [r["ticker"] for r in cur.fetchall()]
+    def load():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "start_tickers", (tg_id, username))
+                tickers = [r["ticker"] for r in cur.fetchall()]
+                conn.commit()
+        return tickers
+
+    tickers = await db_run(load)
 
     if tickers:
         tracked = ", ".join(tickers)
@@ -229,8 +741,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 2:
         return await update.message.reply_text("Uso: /add TICKER DROP%\nEj: /add QQQ 10")
@@ -238,49 +750,52 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ticker = normalize_ticker(context.args[0])
     drop = float(context.args[1])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            INSERT INTO alerts (telegram_id, ticker, drop_pct)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (telegram_id, ticker)
-            DO UPDATE SET drop_pct = EXCLUDED.drop_pct;
-            """, (tg_id, ticker, drop))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_drop", (tg_id, username, ticker, drop))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
     await update.message.reply_text(f"✅ BUY creado: {ticker} ≥ {drop:.1f}% (caída desde máximo 60d)")
 
 
 async def cmd_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 1:
         return await update.message.reply_text("Uso: /remove TICKER\nEj: /remove QQQ")
 
     ticker = normalize_ticker(context.args[0])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM alerts WHERE telegram_id=%s AND ticker=%s;", (tg_id, ticker))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "remove_alert", (tg_id, username, ticker))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
     await update.message.reply_text(f"🗑️ Eliminado: {ticker}")
 
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            SELECT ticker, drop_pct
-            FROM alerts
-            WHERE telegram_id=%s
-            ORDER BY ticker;
-            """, (tg_id,))
-            rows = cur.fetchall()
+    def load():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "list_alerts", (tg_id, username))
+                rows = cur.fetchall()
+                conn.commit()
+        return rows
+
+    rows = await db_run(load)
 
     if not rows:
         return await update.message.reply_text("No tienes alertas. Usa /add TICKER %  (ej: /add QQQ 10)")
@@ -292,22 +807,23 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 1:
         return await update.message.reply_text("Uso: /show TICKER\nEj: /show QQQ")
 
     ticker = normalize_ticker(context.args[0])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            SELECT ticker, drop_pct, entry_price, tp_pct, sl_pct, dca_rules
-            FROM alerts
-            WHERE telegram_id=%s AND ticker=%s;
-            """, (tg_id, ticker))
-            a = cur.fetchone()
+    def load():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "show_alert", (tg_id, username, ticker))
+                a = cur.fetchone()
+                conn.commit()
+        return a
+
+    a = await db_run(load)
 
     if not a:
         return await update.message.reply_text(f"No encuentro {ticker}. Crea primero con /add {ticker} 10")
@@ -333,8 +849,8 @@ async def cmd_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 2:
         return await update.message.reply_text("Uso: /entry TICKER PRICE\nEj: /entry QQQ 450")
@@ -342,22 +858,21 @@ async def cmd_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ticker = normalize_ticker(context.args[0])
     price = float(context.args[1])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            INSERT INTO alerts (telegram_id, ticker, entry_price)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (telegram_id, ticker)
-            DO UPDATE SET entry_price = EXCLUDED.entry_price;
-            """, (tg_id, ticker, price))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_entry", (tg_id, username, ticker, price))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
     await update.message.reply_text(f"📌 Entry guardado {ticker} @ ${price:.2f}")
 
 
 async def cmd_setsell(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 3:
         return await update.message.reply_text("Uso: /setsell TICKER TP% SL%\nEj: /setsell QQQ 10 7")
@@ -366,45 +881,50 @@ async def cmd_setsell(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tp = float(context.args[1])
     sl = float(context.args[2])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            INSERT INTO alerts (telegram_id, ticker, tp_pct, sl_pct)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (telegram_id, ticker)
-            DO UPDATE SET tp_pct = EXCLUDED.tp_pct, sl_pct = EXCLUDED.sl_pct;
-            """, (tg_id, ticker, tp, sl))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_sell", (tg_id, username, ticker, tp, sl))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
     await update.message.reply_text(f"🧾 {ticker} TP={tp:.1f}% | SL={sl:.1f}% (solo alerta)")
 
 
 async def cmd_dca(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 2:
         return await update.message.reply_text("Uso: /dca TICKER 10:15 15:25 20:40\nEj: /dca QQQ 10:15 15:25")
 
     ticker = normalize_ticker(context.args[0])
     rules = parse_dca_rules(context.args[1:])
+    # a typo (10,5:15, 10:15x) must not overwrite the saved rules
+    if len(rules) != len(context.args[1:]):
+        return await update.message.reply_text(
+            "Reglas inválidas. Usa CAÍDA:MONTO con punto decimal.\n"
+            "Uso: /dca TICKER 10:15 15:25 20:40\nEj: /dca QQQ 10:15 15:25"
+        )
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            INSERT INTO alerts (telegram_id, ticker, dca_rules)
-            VALUES (%s, %s, %s::jsonb)
-            ON CONFLICT (telegram_id, ticker)
-            DO UPDATE SET dca_rules = EXCLUDED.dca_rules;
-            """, (tg_id, ticker, json.dumps(rules)))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_dca", (tg_id, username, ticker, json.dumps(rules)))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
-    await update.message.reply_text(f"🧠 DCA guardado para {ticker}: {', '.join(context.args[1:])}")
+    saved = ", ".join(f"{r['drop']:g}:{r['amount']:g}" for r in rules)
+    await update.message.reply_text(f"🧠 DCA guardado para {ticker}: {saved}")
 
 
 async def cmd_setbudget(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 2:
         return await update.message.reply_text("Uso: /setbudget WEEKLY DIPS\nEj: /setbudget 70 40")
@@ -412,22 +932,21 @@ async def cmd_setbudget(update: Update, context: ContextTypes.DEFAULT_TYPE):
     weekly = float(context.args[0])
     dips = float(context.args[1])
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-            INSERT INTO budgets (telegram_id, weekly_budget, dips_budget, updated_at)
-            VALUES (%s, %s, %s, NOW())
-            ON CONFLICT (telegram_id)
-            DO UPDATE SET weekly_budget=EXCLUDED.weekly_budget, dips_budget=EXCLUDED.dips_budget, updated_at=NOW();
-            """, (tg_id, weekly, dips))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_budget", (tg_id, username, weekly, dips))
+                conn.commit()
+
+    await db_run(save)
+    invalidate_snapshot()
 
     await update.message.reply_text(f"💰 Budget guardado: semanal=${weekly:.2f} | dips=${dips:.2f}")
 
 
 async def cmd_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
     if len(context.args) < 2 or len(context.args) % 2 != 0:
         return await update.message.reply_text("Uso: /plan TICKER AMOUNT TICKER AMOUNT...\nEj: /plan QQQ 30 SCHD 20 JEPQ 20")
@@ -438,30 +957,38 @@ async def cmd_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amt = float(context.args[i+1])
         pairs.append((t, amt))
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM plans WHERE telegram_id=%s;", (tg_id,))
-            for t, amt in pairs:
-                cur.execute("""
-                INSERT INTO plans (telegram_id, ticker, amount)
-                VALUES (%s, %s, %s);
-                """, (tg_id, t, amt))
-            conn.commit()
+    def save():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "set_plan", (
+                    tg_id,
+                    username,
+                    [t for t, _ in pairs],
+                    [amt for _, amt in pairs],
+                ))
+                conn.commit()
+
+    await db_run(save)
 
     pretty = " | ".join([f"{t} ${amt:.2f}" for t, amt in pairs])
     await update.message.reply_text(f"📅 Plan lunes guardado: {pretty}")
 
 
 async def cmd_monday(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    upsert_user(update)
     tg_id = update.effective_user.id
+    username = update.effective_user.username
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT weekly_budget, dips_budget FROM budgets WHERE telegram_id=%s;", (tg_id,))
-            b = cur.fetchone()
-            cur.execute("SELECT ticker, amount FROM plans WHERE telegram_id=%s ORDER BY ticker;", (tg_id,))
-            p = cur.fetchall()
+    def load():
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, "monday_budget", (tg_id, username))
+                b = cur.fetchone()
+                cur.execute("SELECT ticker, amount FROM plans WHERE telegram_id=%s ORDER BY ticker;", (tg_id,))
+                p = cur.fetchall()
+                conn.commit()
+        return b, p
+
+    b, p = await db_run(load)
 
     weekly = float(b["weekly_budget"]) if b else 0.0
     dips = float(b["dips_budget"]) if b else 0.0
@@ -485,115 +1012,269 @@ async def cmd_monday(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # BACKGROUND CHECKER
 # =========================
-BUY_COOLDOWN = timedelta(hours=6)
-TP_SL_COOLDOWN = timedelta(hours=3)
+BUY_COOLDOWN = 6 * 3600.0    # seconds
+TP_SL_COOLDOWN = 3 * 3600.0  # seconds
 
-async def check_jobs(context: ContextTypes.DEFAULT_TYPE):
+
+def flush_alert_updates(buy_updates, tp_updates, sl_updates):
     """
-    Runs periodically. Checks all alerts for all users.
-    Sends:
-      - BUY alert when drop >= drop_pct
-      - TP/SL alerts when entry_price defined and target hit
-      - DCA suggestion (if rules exist)
+    Writes the anti-spam columns for every alert fired in this run.
+    One connection, one statement per kind, one commit.
     """
-    app = context.application
-    now = now_utc()
-
-    # Load budgets into dict
+    if not (buy_updates or tp_updates or sl_updates):
+        return
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            if buy_updates:
+                execute_values(cur, """
+                UPDATE alerts AS a
+                SET last_buy_alert_at = v.at, last_buy_drop_sent = v.drop_sent
+                FROM (VALUES %s) AS v(id, at, drop_sent)
+                WHERE a.id = v.id;
+                """, buy_updates, template="(%s, %s::timestamptz, %s::numeric)")
+            if tp_updates:
+                execute_values(cur, """
+                UPDATE alerts AS a
+                SET last_tp_alert_at = v.at
+                FROM (VALUES %s) AS v(id, at)
+                WHERE a.id = v.id;
+                """, tp_updates, template="(%s, %s::timestamptz)")
+            if sl_updates:
+                execute_values(cur, """
+                UPDATE alerts AS a
+                SET last_sl_alert_at = v.at
+                FROM (VALUES %s) AS v(id, at)
+                WHERE a.id = v.id;
+                """, sl_updates, template="(%s, %s::timestamptz)")
+        conn.commit()
+
+
+SNAPSHOT_MAX_AGE = timedelta(hours=1)
+
+# Telegram caps a message at 4096 chars; alerts for one chat share messages
+MESSAGE_MAX_CHARS = 4000
+ALERT_SEPARATOR = "\n\n———\n\n"
+
+# Rows that can fire at all: a BUY threshold, or an entry with TP/SL.
+# Cooldowns stay in Python: a deeper drop bypasses the BUY cooldown and the
+# snapshot outlives any single run.
+ALERT_ACTIVE_SQL = "(drop_pct IS NOT NULL OR (entry_price > 0 AND (tp_pct IS NOT NULL OR sl_pct IS NOT NULL)))"
+
+# budgets/alerts as last read by check_jobs. Handlers that change them call
+# invalidate_snapshot(); writes from other processes arrive as NOTIFYs on
+# SNAPSHOT_CHANNEL (see db_init). Otherwise the rows are reused between runs
+# and the checker patches its own anti-spam columns in place.
+_SNAPSHOT = {"budgets": None, "alerts": None, "loaded_at": None, "us_only": False}
+_SNAPSHOT_STALE = True
+
+
+def invalidate_snapshot():
+    global _SNAPSHOT_STALE
+    _SNAPSHOT_STALE = True
+
+
+def drain_snapshot_notifications():
+    """
+    Non-blocking read of the LISTEN connection; invalidates the snapshot if
+    any NOTIFY arrived. A (re)connect invalidates too, since notifications
+    sent while nobody was listening are lost.
+    """
+    global _LISTEN_CONN
+    try:
+        if _LISTEN_CONN is None or _LISTEN_CONN.closed:
+            _LISTEN_CONN = psycopg2.connect(DATABASE_URL, **DB_CONNECT_KWARGS)
+            _LISTEN_CONN.autocommit = True
+            with _LISTEN_CONN.cursor() as cur:
+                cur.execute("LISTEN " + SNAPSHOT_CHANNEL + ";")
+            invalidate_snapshot()
+            return
+        _LISTEN_CONN.poll()
+        if _LISTEN_CONN.notifies:
+            _LISTEN_CONN.notifies.clear()
+            invalidate_snapshot()
+    except psycopg2.Error:
+        if _LISTEN_CONN is not None:
+            _LISTEN_CONN.close()
+        _LISTEN_CONN = None
+        invalidate_snapshot()
+
+
+def _load_snapshot():
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT telegram_id, weekly_budget, dips_budget FROM budgets;")
+            # only the dips budget matters to the checker
+            cur.execute("SELECT telegram_id, COALESCE(dips_budget, 0)::float8 AS dips_budget FROM budgets;")
             budget_rows = cur.fetchall() or []
-            budgets = {r["telegram_id"]: r for r in budget_rows}
+            budgets = {r["telegram_id"]: r["dips_budget"] for r in budget_rows}
 
             cur.execute("""
             SELECT
-              id, telegram_id, ticker, drop_pct, entry_price, tp_pct, sl_pct, dca_rules,
-              last_buy_alert_at, last_tp_alert_at, last_sl_alert_at, last_buy_drop_sent
-            FROM alerts;
-            """)
+              id, telegram_id, ticker,
+              -- NUMERIC comes back as Decimal; cast once here, not per check
+              drop_pct::float8 AS drop_pct, entry_price::float8 AS entry_price,
+              tp_pct::float8 AS tp_pct, sl_pct::float8 AS sl_pct,
+              CASE WHEN drop_pct IS NOT NULL THEN dca_rules END AS dca_rules,  -- only BUY alerts use it
+              last_buy_alert_at, last_tp_alert_at, last_sl_alert_at,
+              last_buy_drop_sent::float8 AS last_buy_drop_sent
+            FROM alerts
+            WHERE """ + ALERT_ACTIVE_SQL + ";")
             alerts = cur.fetchall() or []
 
-    # Group by ticker to reduce yfinance calls
-    tickers = sorted({a["ticker"] for a in alerts})
-    prices = {}
+    # parse DCA rules and cooldown stamps once per snapshot rather than once
+    # per check; stamps become epoch seconds (0.0 = never sent)
+    for a in alerts:
+        # one shared string per ticker for the set/dict lookups in check_jobs
+        a["ticker"] = sys.intern(a["ticker"])
+        a["dca_rules"] = dca_rules_array(a["dca_rules"])
+        for col in ("buy", "tp", "sl"):
+            at = a.pop(f"last_{col}_alert_at")
+            a[f"last_{col}_ts"] = at.timestamp() if at else 0.0
+        set_next_due(a)
+    return budgets, alerts
 
-    # fetch prices in thread to avoid blocking event loop too hard
-    def fetch_all():
-        out = {}
-        for t in tickers:
-            curp, high60 = fetch_price_and_60d_high(t)
-            out[t] = (curp, high60)
-        return out
 
+def set_next_due(a):
+    """
+    Stores on a snapshot row the earliest epoch second it could send
+    anything, so check_jobs skips cooled-down rows with one comparison.
+    BUY alerts are always due (a deeper drop bypasses the cooldown);
+    TP/SL once the sooner of their cooldowns runs out.
+    """
+    if a["drop_pct"] is not None:
+        a["next_due_ts"] = 0.0
+        return
+    ends = []
+    if a["tp_pct"] is not None:
+        ends.append(a["last_tp_ts"] + TP_SL_COOLDOWN)
+    if a["sl_pct"] is not None:
+        ends.append(a["last_sl_ts"] + TP_SL_COOLDOWN)
+    a["next_due_ts"] = min(ends) if ends else float("inf")
+
+
+async def load_checker_snapshot(us_closed: bool = False):
+    """
+    Returns: (dips budget by telegram_id, alert rows)
+    Re-SELECTs only when a handler changed something or the copy is too old.
+    us_closed: while the US market is closed, a snapshot nobody invalidated
+    that only holds US-session rows has nothing to check; returns
+    (None, None) without a SELECT (the NOTIFY drain is a local poll).
+    """
+    global _SNAPSHOT_STALE
+    await db_run(drain_snapshot_notifications)
+    loaded_at = _SNAPSHOT["loaded_at"]
+    if us_closed and _SNAPSHOT["us_only"] and not _SNAPSHOT_STALE and loaded_at is not None:
+        return None, None
+    if _SNAPSHOT_STALE or loaded_at is None or (now_utc() - loaded_at) >= SNAPSHOT_MAX_AGE:
+        # cleared before the read so an invalidation during it is not lost
+        _SNAPSHOT_STALE = False
+        try:
+            budgets, alerts = await db_run(_load_snapshot)
+        except Exception:
+            # the NOTIFY that asked for this reload is already drained
+            _SNAPSHOT_STALE = True
+            raise
+        us_only = all(_follows_us_session(a["ticker"]) for a in alerts)
+        _SNAPSHOT.update(budgets=budgets, alerts=alerts, loaded_at=now_utc(), us_only=us_only)
+    return _SNAPSHOT["budgets"], _SNAPSHOT["alerts"]
+
+
+async def check_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs periodically. Checks all alerts for all users.
+    Sends:
+      - BUY alert when drop >= drop_pct
+      - TP/SL alerts when entry_price defined and target hit
+      - DCA suggestion (if rules exist)
+    """
+    app = context.application
+    now = now_utc()
+    now_s = now.timestamp()
+
+    us_closed = not _us_market_open(now_s)
+    budgets, alerts = await load_checker_snapshot(us_closed)
+    if alerts is None:
+        return
+    due = [a for a in alerts if now_s >= a["next_due_ts"]]
+    if us_closed:
+        # US equity bars are frozen until the next session; foreign listings,
+        # FX, futures and crypto keep moving
+        due = [a for a in due if not _follows_us_session(a["ticker"])]
+        if not due:
+            return
+
+    # Group by ticker to reduce yfinance calls; only BUY alerts need the 60d high
+    tickers = {a["ticker"] for a in due}
+    need_high = {a["ticker"] for a in due if a["drop_pct"] is not None}
+
+    # fetch prices in thread to avoid blocking event loop too hard
     loop = asyncio.get_running_loop()
-    prices = await loop.run_in_executor(None, fetch_all)
+    prices = await loop.run_in_executor(None, fetch_prices, tickers, need_high)
+
+    # drop from the 60d high, once per ticker rather than once per alert;
+    # None when only TP/SL alerts track the ticker
+    drops = {
+        t: (high60 - current) / high60 * 100.0 if high60 else None
+        for t, (current, high60) in prices.items()
+        if current is not None
+    }
+
+    # Spam-control timestamps, flushed in one transaction after the loop
+    buy_updates = []
+    tp_updates = []
+    sl_updates = []
+    # chat_id -> [(text, staged update list, update row)] in scan order
+    outgoing = {}
 
     # Process each alert
-    for a in alerts:
+    for a in due:
         tg_id = a["telegram_id"]
         ticker = a["ticker"]
-        current, high60 = prices.get(ticker, (None, None))
-        if current is None or high60 is None or high60 <= 0:
+        if ticker not in drops:
             continue
+        current, high60 = prices[ticker]
+        drop_pct = drops[ticker]
 
-        drop_pct = (high60 - current) / high60 * 100.0
-
-        dips_budget = float(budgets.get(tg_id, {}).get("dips_budget", 0) or 0)
+        dips_budget = budgets.get(tg_id, 0.0)
 
         # ---------- BUY drop alert ----------
-        if a["drop_pct"] is not None:
-            threshold = float(a["drop_pct"])
-            last_at = a["last_buy_alert_at"]
+        if a["drop_pct"] is not None and drop_pct is not None:
+            threshold = a["drop_pct"]
+            last_ts = a["last_buy_ts"]
             last_sent_drop = a["last_buy_drop_sent"]
 
-            cooldown_ok = (last_at is None) or ((now - last_at) >= BUY_COOLDOWN)
-            deeper_drop = (last_sent_drop is None) or (drop_pct >= float(last_sent_drop) + 2.0)
+            cooldown_ok = (now_s - last_ts) >= BUY_COOLDOWN
+            deeper_drop = (last_sent_drop is None) or (drop_pct >= last_sent_drop + 2.0)
 
             if drop_pct >= threshold and (cooldown_ok or deeper_drop):
                 # DCA suggestion
-                dca_rules = a["dca_rules"] or []
-                suggested = dca_suggest_amount(dca_rules, drop_pct, dips_budget)
+                suggested = dca_suggest_amount(a["dca_rules"], drop_pct, dips_budget)
+
+                if suggested:
+                    dca_line = f"🧠 DCA sugerido (según tu regla): ${suggested:.2f}"
+                else:
+                    dca_line = "🧠 DCA: (sin regla o no aplica todavía)"
 
                 msg = (
                     f"📉 ALERTA: {ticker}\n"
                     f"Caída: {drop_pct:.1f}% desde el máximo 60d\n"
                     f"Precio aprox: ${current:.2f}\n"
                     f"Máximo 60d: ${high60:.2f}\n"
+                    f"\n{dca_line}"
+                    "\n\n👉 Si vas a comprar, dime cuánto quieres meter y te digo cómo repartirlo."
                 )
-                if suggested:
-                    msg += f"\n🧠 DCA sugerido (según tu regla): ${suggested:.2f}"
-                else:
-                    msg += "\n🧠 DCA: (sin regla o no aplica todavía)"
 
-                msg += "\n\n👉 Si vas a comprar, dime cuánto quieres meter y te digo cómo repartirlo."
-
-                try:
-                    await app.bot.send_message(chat_id=tg_id, text=msg)
-                except:
-                    pass
-
-                # update spam control
-                with db_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""
-                        UPDATE alerts
-                        SET last_buy_alert_at=%s, last_buy_drop_sent=%s
-                        WHERE id=%s;
-                        """, (now, drop_pct, a["id"]))
-                        conn.commit()
+                # update spam control once the message went out
+                outgoing.setdefault(tg_id, []).append((msg, buy_updates, (a["id"], now, drop_pct)))
 
         # ---------- TP/SL alerts ----------
         entry = a["entry_price"]
         if entry is not None and (a["tp_pct"] is not None or a["sl_pct"] is not None):
-            entry = float(entry)
             if entry > 0:
                 # TP
                 if a["tp_pct"] is not None:
-                    tp = float(a["tp_pct"])
+                    tp = a["tp_pct"]
                     tp_price = entry * (1.0 + tp / 100.0)
-                    last_tp = a["last_tp_alert_at"]
-                    if current >= tp_price and ((last_tp is None) or ((now - last_tp) >= TP_SL_COOLDOWN)):
+                    if current >= tp_price and (now_s - a["last_tp_ts"]) >= TP_SL_COOLDOWN:
                         msg = (
                             f"✅ TP ALERTA: {ticker}\n"
                             f"Entry: ${entry:.2f}\n"
@@ -601,21 +1282,13 @@ async def check_jobs(context: ContextTypes.DEFAULT_TYPE):
                             f"Precio actual: ${current:.2f}\n\n"
                             "⚠️ Solo alerta. Tú decides vender."
                         )
-                        try:
-                            await app.bot.send_message(chat_id=tg_id, text=msg)
-                        except:
-                            pass
-                        with db_conn() as conn:
-                            with conn.cursor() as cur:
-                                cur.execute("UPDATE alerts SET last_tp_alert_at=%s WHERE id=%s;", (now, a["id"]))
-                                conn.commit()
+                        outgoing.setdefault(tg_id, []).append((msg, tp_updates, (a["id"], now)))
 
                 # SL
                 if a["sl_pct"] is not None:
-                    sl = float(a["sl_pct"])
+                    sl = a["sl_pct"]
                     sl_price = entry * (1.0 - sl / 100.0)
-                    last_sl = a["last_sl_alert_at"]
-                    if current <= sl_price and ((last_sl is None) or ((now - last_sl) >= TP_SL_COOLDOWN)):
+                    if current <= sl_price and (now_s - a["last_sl_ts"]) >= TP_SL_COOLDOWN:
                         msg = (
                             f"🛑 SL ALERTA: {ticker}\n"
                             f"Entry: ${entry:.2f}\n"
@@ -623,44 +1296,132 @@ async def check_jobs(context: ContextTypes.DEFAULT_TYPE):
                             f"Precio actual: ${current:.2f}\n\n"
                             "⚠️ Solo alerta. Tú decides qué hacer."
                         )
-                        try:
-                            await app.bot.send_message(chat_id=tg_id, text=msg)
-                        except:
-                            pass
-                        with db_conn() as conn:
-                            with conn.cursor() as cur:
-                                cur.execute("UPDATE alerts SET last_sl_alert_at=%s WHERE id=%s;", (now, a["id"]))
-                                conn.commit()
+                        outgoing.setdefault(tg_id, []).append((msg, sl_updates, (a["id"], now)))
+
+    # One sender per chat: a user's alerts are merged into as few messages
+    # as Telegram's length limit allows, in scan order, while different
+    # chats go out concurrently. Delivered alerts get their cooldown stamped,
+    # and so do permanent failures (bot blocked, chat gone) so they are not
+    # retried every run; transient errors leave them due for the next run.
+    async def send_user(chat_id, messages):
+        # [texts, stamps, length] per outgoing message
+        chunks = []
+        for text, staged, row in messages:
+            if chunks and chunks[-1][2] + len(ALERT_SEPARATOR) + len(text) <= MESSAGE_MAX_CHARS:
+                chunks[-1][0].append(text)
+                chunks[-1][1].append((staged, row))
+                chunks[-1][2] += len(ALERT_SEPARATOR) + len(text)
+            else:
+                chunks.append([[text], [(staged, row)], len(text)])
+
+        for texts, stamps, _ in chunks:
+            try:
+                await app.bot.send_message(chat_id=chat_id, text=ALERT_SEPARATOR.join(texts))
+            except (Forbidden, BadRequest):
+                pass
+            except Exception:
+                continue
+            for staged, row in stamps:
+                staged.append(row)
+
+    await asyncio.gather(*(send_user(c, m) for c, m in outgoing.items()))
+
+    await db_run(flush_alert_updates, buy_updates, tp_updates, sl_updates)
+
+    # keep the cached rows in line with what was just written
+    by_id = {a["id"]: a for a in alerts}
+    for alert_id, _, drop_sent in buy_updates:
+        by_id[alert_id].update(last_buy_ts=now_s, last_buy_drop_sent=drop_sent)
+    for alert_id, _ in tp_updates:
+        by_id[alert_id]["last_tp_ts"] = now_s
+        set_next_due(by_id[alert_id])
+    for alert_id, _ in sl_updates:
+        by_id[alert_id]["last_sl_ts"] = now_s
+        set_next_due(by_id[alert_id])
 
 
 # =========================
 # MAIN
 # =========================
+COMMANDS = (
+    ("start", cmd_start),
+    ("add", cmd_add),
+    ("remove", cmd_remove),
+    ("list", cmd_list),
+    ("show", cmd_show),
+    ("entry", cmd_entry),
+    ("setsell", cmd_setsell),
+    ("dca", cmd_dca),
+    ("setbudget", cmd_setbudget),
+    ("plan", cmd_plan),
+    ("monday", cmd_monday),
+)
+
+
+async def on_shutdown(app: Application):
+    db_close()
+
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("Falta TELEGRAM_BOT_TOKEN en Render (Environment Variables).")
 
     db_init()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    # libuv loop: cheaper socket dispatch for polling, sends and Postgres NOTIFY
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # HTTP/2 keeps one multiplexed, kept-alive connection to api.telegram.org
+    # instead of a TLS handshake per burst of requests
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=32, pool_timeout=5.0, http_version="2"))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        # shapes checker bursts to Telegram's 30 msg/s and retries 429s
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        # commands from different chats run in parallel (each waits on Postgres);
+        # capped below the pool size (one connection left for check_jobs) so
+        # getconn() never finds the pool exhausted
+        .concurrent_updates(DB_POOL_MAX - 1)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Commands
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("add", cmd_add))
-    app.add_handler(CommandHandler("remove", cmd_remove))
-    app.add_handler(CommandHandler("list", cmd_list))
-    app.add_handler(CommandHandler("show", cmd_show))
-    app.add_handler(CommandHandler("entry", cmd_entry))
-    app.add_handler(CommandHandler("setsell", cmd_setsell))
-    app.add_handler(CommandHandler("dca", cmd_dca))
-    app.add_handler(CommandHandler("setbudget", cmd_setbudget))
-    app.add_handler(CommandHandler("plan", cmd_plan))
-    app.add_handler(CommandHandler("monday", cmd_monday))
+    app.add_handlers([CommandHandler(name, fn) for name, fn in COMMANDS])
 
     # Job queue: cada 5 minutos (puedes cambiar a 300, 600, etc.)
-    app.job_queue.run_repeating(check_jobs, interval=300, first=15)
+    # PTB's scheduler already runs one instance at a time and coalesces missed
+    # ticks. misfire_grace_time lets a tick that starts up to 60s late still
+    # run instead of being skipped. The interval trigger is anchored to the
+    # start time, so runs do not drift; jitter spreads them off the exact
+    # 5-minute marks other pollers hit.
+    app.job_queue.run_repeating(
+        check_jobs,
+        interval=300,
+        first=15,
+        job_kwargs={"misfire_grace_time": 60, "jitter": 20},
+    )
 
-    app.run_polling(close_loop=False)
+    if WEBHOOK_URL:
+        # Telegram POSTs each update to us: no getUpdates traffic at all.
+        # Unguessable path derived from the token (never the token itself,
+        # which would end up in access logs).
+        url_path = "tg-" + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=url_path,
+            webhook_url=WEBHOOK_URL.rstrip("/") + "/" + url_path,
+            secret_token=WEBHOOK_SECRET,
+            close_loop=False,
+        )
+    else:
+        # long poll: Telegram holds getUpdates open up to 30s, so an idle bot
+        # makes ~2 requests a minute instead of one every 10s
+        app.run_polling(timeout=30, close_loop=False)
 
 
 if __name__ == "__main__":